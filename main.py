@@ -1,28 +1,22 @@
 import os
-import base64
+import asyncio
+import functools
 import argparse
 
-from dotenv import load_dotenv
-load_dotenv()
+try:
+    # SIMD base64 codec (AVX2/AVX-512), much faster on large payloads
+    import pybase64 as base64
+except ImportError:
+    import base64
 
-from io import BytesIO
-from openai import OpenAI
+import numpy as np
 from PIL import Image, ImageFilter
+from scipy.ndimage import binary_closing, binary_opening
 
 # -----------------------------------------
 # CONFIG
 # -----------------------------------------
 
-API_KEY = os.getenv("OPENAI_API_KEY")
-if not API_KEY:
-    raise RuntimeError(
-        "OPENAI_API_KEY is missing.\n"
-        "Create a .env file with:\n"
-        "OPENAI_API_KEY=sk-xxxxx\n"
-    )
-
-client = OpenAI(api_key=API_KEY)
-
 PORTRAIT_FILE = "portrait_stage.png"   # raw generation
 CUTOUT_FILE   = "portrait_cutout.png"  # background removed
 FINAL_FILE    = "home_alone_final.png"
@@ -43,30 +37,222 @@ BACKGROUND_PATH = "templates/bg.jpg"
 # HELPERS
 # -----------------------------------------
 
+def make_client():
+    """Create the OpenAI client (use as `async with make_client() as client`).
+
+    openai / httpx / dotenv are imported here rather than at module level,
+    so --skip-gen (local-only) runs never pay their import cost. The client
+    and its connection pool belong to the event loop that uses them, so
+    create one per async entry point and let `async with` close it.
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError(
+            "OPENAI_API_KEY is missing.\n"
+            "Create a .env file with:\n"
+            "OPENAI_API_KEY=sk-xxxxx\n"
+        )
+
+    # One keep-alive HTTP/2 pool: TLS/TCP setup is paid once and reused by
+    # every generate_clean_portrait call sharing this client (e.g. batches).
+    # DefaultAsyncHttpxClient keeps the SDK's own settings (timeout,
+    # redirects); only HTTP/2 and the pool limits are overridden.
+    http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    )
+
+    # Async client so several generations can overlap on the network
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+
 def load_image_file(path: str):
-    """Load the file directly for OpenAI API."""
+    """Load the file directly for OpenAI API.
+
+    Returns a (filename, bytes) upload tuple. The original bytes are
+    uploaded as-is (no PIL decode / re-encode), so JPEG inputs stay JPEG
+    and small, and the file is closed right away.
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Image not found: {path}")
-    return open(path, "rb")
+    with open(path, "rb") as f:
+        return os.path.basename(path), f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def load_reference_image(path: str):
+    """Read a static reference image once per process.
+
+    Every call in a batch reuses the same in-memory upload tuple instead
+    of re-reading the file.
+    """
+    return load_image_file(path)
 
 
 def save_output(b64_data: str, output_path: str):
-    img_bytes = base64.b64decode(b64_data)
-    img = Image.open(BytesIO(img_bytes))
-    img.save(output_path)
+    # The API already returns PNG bytes, so write them verbatim instead of
+    # decoding + re-encoding through PIL.
+    img_bytes = base64.b64decode(b64_data, validate=False)
+    with open(output_path, "wb") as f:
+        f.write(img_bytes)
     print(f"✔ Saved: {output_path}")
 
 
+def _lanczos_weights(in_n: int, out_n: int, a: int = 3):
+    """Sparse (out_n x in_n) Lanczos resampling matrix for one axis."""
+    # Imported here: scipy.sparse costs ~0.16s and only this helper uses it
+    from scipy import sparse
+
+    scale = in_n / out_n
+    fscale = max(scale, 1.0)   # widen the kernel when downscaling
+    support = a * fscale
+
+    rows, cols, vals = [], [], []
+    for i in range(out_n):
+        center = (i + 0.5) * scale
+        lo = max(int(center - support), 0)
+        hi = min(int(center + support) + 1, in_n)
+        j = np.arange(lo, hi)
+        x = (j + 0.5 - center) / fscale
+        w = np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0.0)
+        w /= w.sum()
+        rows.extend([i] * len(j))
+        cols.extend(j)
+        vals.extend(w)
+
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(out_n, in_n))
+
+
+def banded_lanczos_resize(arr: np.ndarray, out_h: int, out_w: int, a: int = 3, block: int = 16):
+    """Separable Lanczos resize of an H x W (x C) array via banded sparse matrices.
+
+    Slower than Image.resize, but the kernel is plain NumPy so it can be
+    swapped (Mitchell, pre-sharpen, ...). Coefficients are built once per
+    axis; output is produced `block` rows at a time to stay cache friendly.
+    """
+    if arr.ndim == 2:  # single-channel ("L") input
+        return banded_lanczos_resize(arr[..., None], out_h, out_w, a, block)[..., 0]
+
+    h, w, c = arr.shape
+    m_v = _lanczos_weights(h, out_h, a)
+    m_h = _lanczos_weights(w, out_w, a)
+
+    src = arr.reshape(h, w * c).astype(np.float32)
+    out = np.empty((out_h, out_w, c), dtype=np.float32)
+
+    for y0 in range(0, out_h, block):
+        y1 = min(y0 + block, out_h)
+        # vertical pass: (rows, W*C)
+        vert = (m_v[y0:y1] @ src).reshape(y1 - y0, w, c)
+        # horizontal pass: (rows*C, W) @ (W, out_w)
+        vert = vert.transpose(0, 2, 1).reshape(-1, w)
+        horiz = (m_h @ vert.T).T
+        out[y0:y1] = horiz.reshape(y1 - y0, c, out_w).transpose(0, 2, 1)
+
+    if arr.dtype == np.uint8:
+        return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+    return out.astype(arr.dtype)
+
+
+def composite_premultiplied(bg: Image.Image, fg: Image.Image, pos: tuple):
+    """Porter-Duff "over" of a premultiplied ("RGBa") fg onto an RGB/RGBA bg.
+
+    out = fg + bg * (1 - fg_alpha), so there is no per-pixel unpremultiply
+    divide. Only the region covered by fg is touched; fg may hang off any
+    edge of bg (like paste). An RGB bg stays RGB (fg alpha is only used as
+    the blend weight).
+    """
+    x, y = pos
+    out = np.array(bg)
+    src = np.asarray(fg)
+
+    # Overlap of fg with bg, in bg coordinates
+    x0, y0 = max(x, 0), max(y, 0)
+    x1 = min(x + src.shape[1], out.shape[1])
+    y1 = min(y + src.shape[0], out.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return Image.fromarray(out)
+
+    src = src[y0 - y:y1 - y, x0 - x:x1 - x].astype(np.uint16)
+    dst = out[y0:y1, x0:x1].astype(np.uint16)
+
+    inv_a = 255 - src[..., 3:4]
+    dst = src[..., :dst.shape[-1]] + (dst * inv_a + 127) // 255
+    # Lanczos ringing on premultiplied data can leave rgb > alpha, which
+    # would push the sum past 255 and wrap around; clamp before the cast
+    out[y0:y1, x0:x1] = np.minimum(dst, 255).astype(np.uint8)
+    return Image.fromarray(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _chroma_mask_jit():
+    """Build the Numba mask kernel, or return None if numba isn't installed.
+
+    numba is imported here rather than at module level: importing it alone
+    costs ~0.4s, which local-only runs shouldn't pay up front.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def kernel(cbcr, bg_cb, bg_cr, thr2):
+        h, w, _ = cbcr.shape
+        out = np.empty((h, w), dtype=np.bool_)
+        for y in prange(h):
+            for x in range(w):
+                dcb = np.int32(cbcr[y, x, 0]) - bg_cb
+                dcr = np.int32(cbcr[y, x, 1]) - bg_cr
+                out[y, x] = dcb * dcb + dcr * dcr > thr2
+        return out
+
+    return kernel
+
+
+def build_chroma_mask(cbcr: np.ndarray, bg_cbcr: np.ndarray, thr2: int, use_jit: bool = False):
+    """True where a pixel's squared CbCr distance to bg_cbcr exceeds thr2.
+
+    Defaults to a NumPy lookup table (~17ms for a 1024x1536 portrait).
+    use_jit=True runs the Numba kernel instead (if numba is installed); it
+    only pays off when masking many images in one process, since the numba
+    import and JIT compile cost far more than a single LUT pass.
+    """
+    kernel = _chroma_mask_jit() if use_jit else None
+    if kernel is not None:
+        return kernel(cbcr, np.int32(bg_cbcr[0]), np.int32(bg_cbcr[1]), np.int32(thr2))
+
+    # bg_cbcr and thr2 are fixed for the run, so precompute the keep/remove
+    # decision for all 256x256 (Cb, Cr) pairs (64 KB). Each pixel is then
+    # one indexed load, no arithmetic.
+    i = np.arange(256, dtype=np.int32)
+    d_cb2 = (i - bg_cbcr[0]) ** 2
+    d_cr2 = (i - bg_cbcr[1]) ** 2
+    lut = (d_cb2[:, None] + d_cr2[None, :]) > thr2
+    return lut[cbcr[..., 0], cbcr[..., 1]]
+
+
 # -----------------------------------------
 # STEP 1 — Generate safe portrait (OPTIONAL)
 # -----------------------------------------
 
-def generate_clean_portrait(user_image_path: str):
+async def generate_clean_portrait(user_image_path: str, output_path: str = PORTRAIT_FILE, client=None):
+    # Standalone call: open (and close) a client just for this generation
+    if client is None:
+        async with make_client() as client:
+            return await generate_clean_portrait(user_image_path, output_path, client)
+
     print("🎨 Generating portrait with gpt-image-1...")
 
     image_files = [load_image_file(user_image_path)]
     for ref in REFERENCE_IMAGES:
-        image_files.append(load_image_file(ref))
+        image_files.append(load_reference_image(ref))
 
     SAFE_PROMPT = """
     Create a portrait of the person wearing the exact Home Alone “Le Tigre” sweater.
@@ -91,7 +277,7 @@ def generate_clean_portrait(user_image_path: str):
     Keep the person's face realistic and sharp.
     """
 
-    result = client.images.edit(
+    result = await client.images.edit(
         model="gpt-image-1",
         image=image_files,
         prompt=SAFE_PROMPT,
@@ -99,15 +285,32 @@ def generate_clean_portrait(user_image_path: str):
     )
 
     b64 = result.data[0].b64_json
-    save_output(b64, PORTRAIT_FILE)
+    save_output(b64, output_path)
     print("✅ Portrait generated.")
 
 
+async def generate_clean_portraits(user_image_paths: list, output_paths: list):
+    """Generate several portraits concurrently (one API call per input).
+
+    All calls share one client, so they reuse the same connection pool.
+    """
+    if len(user_image_paths) != len(output_paths):
+        raise ValueError(
+            f"Got {len(user_image_paths)} input images but {len(output_paths)} output paths."
+        )
+
+    async with make_client() as client:
+        return await asyncio.gather(*[
+            generate_clean_portrait(src, dst, client)
+            for src, dst in zip(user_image_paths, output_paths)
+        ])
+
+
 # -----------------------------------------
 # STEP 2 — Remove blue background (LOCAL ONLY)
 # -----------------------------------------
 
-def remove_background():
+def remove_background(keep_intermediates: bool = False, use_jit: bool = False):
     print("✂ Removing background from portrait_stage.png...")
 
     if not os.path.exists(PORTRAIT_FILE):
@@ -115,76 +318,121 @@ def remove_background():
 
     img = Image.open(PORTRAIT_FILE).convert("RGBA")
     w, h = img.size
-    pixels = img.load()
-
-    # Sample BG color from top-center
-    sample_x = w // 2
-    sample_y = 10
-    bg_r, bg_g, bg_b, bg_a = pixels[sample_x, sample_y]
-
-    # Create mask: 255 = keep, 0 = remove
-    mask = Image.new("L", (w, h), 0)
-    mask_pixels = mask.load()
-
-    def rgb_dist2(r, g, b, rr, gg, bb):
-        dr = r - rr
-        dg = g - gg
-        db = b - bb
-        return dr*dr + dg*dg + db*db
-
-    # threshold controls how strict the BG detection is
-    # start with 35; you can tweak to 25–50 if needed
-    THR = 35
+
+    # Key on chroma only: convert once to YCbCr and drop Y, so the distance
+    # is 2 squared terms instead of 3 and mild brightness variation on the
+    # backdrop matters less than in RGB. Not fully luma-invariant: in PIL's
+    # YCbCr, (Cb-128, Cr-128) scale with brightness, so deep shadows on the
+    # blue drift toward neutral chroma (gray/black).
+    cbcr = np.asarray(img.convert("YCbCr"))[..., 1:3]
+
+    # Model the BG chroma from 20x20 patches around the frame: along the top
+    # edge (left/center/right) plus the left and right edges at mid and
+    # lower height, so gradual drift across the backdrop (blue usually
+    # darkens toward the bottom) is measured, not just noise in one strip.
+    # The bottom corners are skipped: the subject's shoulders usually fill
+    # them in a portrait.
+    P = 20
+    patches = [
+        cbcr[:P, :P],
+        cbcr[:P, w // 2 - P // 2:w // 2 + P // 2],
+        cbcr[:P, -P:],
+        cbcr[h // 2:h // 2 + P, :P],
+        cbcr[h // 2:h // 2 + P, -P:],
+        cbcr[3 * h // 4:3 * h // 4 + P, :P],
+        cbcr[3 * h // 4:3 * h // 4 + P, -P:],
+    ]
+    patches = [p.reshape(-1, 2).astype(np.float32) for p in patches]
+    bg_cbcr = np.median(np.concatenate(patches), axis=0).astype(np.int32)
+
+    # Spread = farthest patch from the BG model (drift), plus per-patch noise
+    drift = max(np.linalg.norm(np.median(p, axis=0) - bg_cbcr) for p in patches)
+    sigma = np.mean([p.std(axis=0).mean() for p in patches])
+
+    # threshold controls how strict the BG detection is. The floor is the
+    # old hand-tuned RGB value of 35 in CbCr units (distances here are
+    # roughly half the RGB ones); widen it for measured drift + 3 sigma of
+    # noise, capped so a patch landing on the subject can't eat the cutout.
+    THR = int(min(max(18, drift + 3 * sigma), 28))
     THR2 = THR * THR
 
-    for y in range(h):
-        for x in range(w):
-            r, g, b, a = pixels[x, y]
-            d2 = rgb_dist2(r, g, b, bg_r, bg_g, bg_b)
-            if d2 > THR2:   # far from BG color -> keep
-                mask_pixels[x, y] = 255
-            else:
-                mask_pixels[x, y] = 0
+    # Create mask: True = keep (far from BG chroma), False = remove
+    keep = build_chroma_mask(cbcr, bg_cbcr, THR2, use_jit=use_jit)
+
+    # Clean up speckle with a 3x3 open/close: opening drops isolated "keep"
+    # pixels in the background, closing fills small holes inside the subject
+    # (e.g. blue-ish flecks on the sweater)
+    se = np.ones((3, 3), dtype=bool)
+    keep = binary_opening(keep, structure=se)
+    keep = binary_closing(keep, structure=se)
 
-    # Soften edges a little
-    mask = mask.filter(ImageFilter.GaussianBlur(radius=2))
+    mask_arr = keep.view(np.uint8) * 255
+    mask = Image.fromarray(mask_arr)  # 2D uint8 -> "L"
+
+    # Feather the edge by ~1px so the cutout doesn't look jagged
+    mask = mask.filter(ImageFilter.BoxBlur(1))
 
     # Apply mask as alpha
     img.putalpha(mask)
-    img.save(CUTOUT_FILE)
-    print("✅ Background removed -> portrait_cutout.png")
+
+    # The cutout is handed straight to compose_final(); only write it out
+    # when asked, to skip a PNG encode + decode round-trip.
+    if keep_intermediates:
+        img.save(CUTOUT_FILE, format="PNG", compress_level=1)
+        print("✅ Background removed -> portrait_cutout.png")
+    else:
+        print("✅ Background removed")
+    return img
 
 
 # -----------------------------------------
 # STEP 3 — Composite onto bg.jpg (LOCAL ONLY)
 # -----------------------------------------
 
-def compose_final():
+def compose_final(cutout: Image.Image = None):
     print("🧩 Compositing final poster...")
 
-    if not os.path.exists(CUTOUT_FILE):
+    # Without an in-memory cutout, fall back to the saved intermediate
+    if cutout is None and not os.path.exists(CUTOUT_FILE):
         raise RuntimeError("portrait_cutout.png missing. Run remove_background() first.")
 
     if not os.path.exists(BACKGROUND_PATH):
         raise RuntimeError("Background template missing. Expected at templates/bg.jpg")
 
-    bg = Image.open(BACKGROUND_PATH).convert("RGBA")
-    cutout = Image.open(CUTOUT_FILE).convert("RGBA")
+    bg = Image.open(BACKGROUND_PATH)
+    # Let libjpeg shrink-on-load if someone drops in an oversized template.
+    # No-op for the current bg.jpg; target ~2x poster for quality headroom.
+    bg.draft("RGB", (2048, 3072))
+    # The JPEG has no alpha and the poster is opaque: stay in RGB (3 B/px)
+    bg = bg.convert("RGB")
+    if cutout is None:
+        cutout = Image.open(CUTOUT_FILE)
+    cutout = cutout.convert("RGBA")
+
+    # Premultiply alpha once up front ("RGBa"). Resizing premultiplied data
+    # keeps RGB from fully transparent pixels from bleeding into the edge
+    # (no halo), and Pillow resizes "RGBa" as-is instead of converting to
+    # and from premultiplied internally.
+    cutout = cutout.convert("RGBa")
 
     # Resize cutout to fit your window area nicely
     # Adjust target_w/target_h until it visually matches your design
     target_w = 950
     scale = target_w / cutout.width
     target_h = int(cutout.height * scale)
-    cutout = cutout.resize((target_w, target_h), Image.LANCZOS)
+    # reducing_gap: cheap integer reduce() first when downscaling a lot,
+    # then Lanczos on the smaller image
+    cutout = cutout.resize((target_w, target_h), Image.LANCZOS, reducing_gap=3.0)
 
     # Position (x, y) so face sits nicely in the center window.
     # Tweak y until it looks perfect with your bg.jpg
     x = (bg.width - cutout.width) // 2
     y = 330  # adjust this number to move portrait up/down
 
-    bg.paste(cutout, (x, y), cutout)
-    bg.save(FINAL_FILE)
+    bg = composite_premultiplied(bg, cutout, (x, y))
+    # zlib level 1: ~5x faster than the default 6 for a ~20% bigger file.
+    # Recompress once at the edge if the poster is served over HTTP.
+    bg.save(FINAL_FILE, format="PNG", compress_level=1, optimize=False)
 
     print(f"🎬 Final poster created: {FINAL_FILE}")
 
@@ -204,6 +452,11 @@ if __name__ == "__main__":
         action="store_true",
         help="Do NOT call OpenAI. Use existing portrait_stage.png.",
     )
+    parser.add_argument(
+        "--keep-intermediates",
+        action="store_true",
+        help="Also save the background-removed portrait to portrait_cutout.png.",
+    )
     args = parser.parse_args()
 
     print("\n🎬 HOME ALONE POSTER GENERATOR\n")
@@ -219,10 +472,10 @@ if __name__ == "__main__":
             print("❌ File not found. Exiting.")
             raise SystemExit(1)
 
-        generate_clean_portrait(user_img)
+        asyncio.run(generate_clean_portrait(user_img))
     else:
         print("⏭ Skipping generation, using existing portrait_stage.png")
 
     # Local-only steps: free, no API cost
-    remove_background()
-    compose_final()
+    cutout = remove_background(keep_intermediates=args.keep_intermediates)
+    compose_final(cutout)